@@ -30,10 +30,13 @@
 #     Exit based on status
 
 import gradle
+import json
+from multiprocessing.pool import ThreadPool
 import optparse
 import os
 import subprocess
 import sys
+import threading
 import time
 import utils
 import run_on_app
@@ -54,6 +57,8 @@ STDERR = 'stderr'
 STDOUT = 'stdout'
 EXITCODE = 'exitcode'
 TIMED_OUT = 'timed_out'
+# Holds both the EXITCODE and TIMED_OUT values.
+META = 'meta.json'
 
 BENCHMARK_APPS = [
     {
@@ -93,9 +98,11 @@ BENCHMARK_APPS = [
     },
 ]
 
-def find_min_xmx_command(record):
-  assert record['find-xmx-min'] < record['find-xmx-max']
-  assert record['find-xmx-range'] < record['find-xmx-max'] - record['find-xmx-min']
+def benchmark_out_dir(record):
+  # Apps are compiled concurrently, so each needs its own output directory.
+  return os.path.join('build', TEST_RESULT_DIR, record['app'])
+
+def run_on_app_command(record, args):
   return [
       'tools/run_on_app.py',
       '--compiler=r8',
@@ -103,37 +110,41 @@ def find_min_xmx_command(record):
       '--app=%s' % record['app'],
       '--version=%s' % record['version'],
       '--no-debug',
+      # r8lib is built by TEST_COMMANDS and the java version is checked once
+      # by run_once, there is no need to redo this for every command.
       '--no-build',
+      '--ignore-java-version',
+      '--out=%s' % benchmark_out_dir(record)
+  ] + args
+
+def find_min_xmx_command(record):
+  assert record['find-xmx-min'] < record['find-xmx-max']
+  assert record['find-xmx-range'] < record['find-xmx-max'] - record['find-xmx-min']
+  return run_on_app_command(record, [
       '--find-min-xmx',
       '--find-min-xmx-min-memory=%s' % record['find-xmx-min'],
       '--find-min-xmx-max-memory=%s' % record['find-xmx-max'],
       '--find-min-xmx-range-size=%s' % record['find-xmx-range'],
-      '--find-min-xmx-archive']
+      '--find-min-xmx-archive'])
 
 def compile_with_memory_max_command(record):
-  return [] if 'skip-find-xmx-max' in record else [
-      'tools/run_on_app.py',
-      '--compiler=r8',
-      '--compiler-build=lib',
-      '--app=%s' % record['app'],
-      '--version=%s' % record['version'],
-      '--no-debug',
-      '--no-build',
+  return [] if 'skip-find-xmx-max' in record else run_on_app_command(record, [
       '--max-memory=%s' % int(record['oom-threshold'] * 1.15)
-  ]
+  ])
 
 def compile_with_memory_min_command(record):
-  return [
-      'tools/run_on_app.py',
-      '--compiler=r8',
-      '--compiler-build=lib',
-      '--app=%s' % record['app'],
-      '--version=%s' % record['version'],
-      '--no-debug',
-      '--no-build',
+  return run_on_app_command(record, [
       '--expect-oom',
       '--max-memory=%s' % int(record['oom-threshold'] * 0.85)
-  ]
+  ])
+
+def benchmark_commands(record):
+  # Drop the empty commands for skipped steps.
+  return [cmd for cmd in [
+      find_min_xmx_command(record),
+      compile_with_memory_max_command(record),
+      compile_with_memory_min_command(record)
+  ] if cmd]
 
 TEST_COMMANDS = [
     # Run test.py internal testing.
@@ -141,15 +152,21 @@ TEST_COMMANDS = [
      '--java_max_memory_size=8G'],
     # Ensure that all internal apps compile.
     ['tools/run_on_app.py', '--run-all', '--out=out'],
-    # Find min xmx for selected benchmark apps
+    # Build r8lib for the benchmark app commands below.
     ['tools/gradle.py', 'r8lib'],
-] + (map(find_min_xmx_command, BENCHMARK_APPS)
-     + map(compile_with_memory_max_command, BENCHMARK_APPS)
-     + map(compile_with_memory_min_command, BENCHMARK_APPS))
+]
+
+# The benchmark apps are independent of each other, so after running
+# TEST_COMMANDS the commands for the different apps are run concurrently.
+# The commands for a single app are still run in order.
+BENCHMARK_COMMANDS = [benchmark_commands(record) for record in BENCHMARK_APPS]
+# Bot does not have a lot of memory, limit the number of concurrent apps.
+BENCHMARK_WORKERS = 2
 
 # Command timeout, in seconds.
 RUN_TIMEOUT = 3600 * 6
-BOT_RUN_TIMEOUT = RUN_TIMEOUT * len(TEST_COMMANDS)
+BOT_RUN_TIMEOUT = RUN_TIMEOUT * (
+    len(TEST_COMMANDS) + sum([len(cmds) for cmds in BENCHMARK_COMMANDS]))
 
 def log(str):
   print("%s: %s" % (time.strftime("%c"), str))
@@ -169,13 +186,25 @@ def ParseOptions():
   result.add_option('--archive',
        help='Post result to GCS, implied by --continuous',
        default=False, action='store_true')
+  result.add_option('--storage_client',
+       help='Access GCS through the google cloud storage library instead of '
+            'gsutil.py, requires application default credentials.',
+       default=False, action='store_true')
   return result.parse_args()
 
 def get_own_file_content():
   with open(sys.argv[0], 'r') as us:
     return us.read()
 
-def restart_if_new_version(original_content):
+def get_own_file_stat():
+  stat = os.stat(sys.argv[0])
+  return (stat.st_mtime, stat.st_size)
+
+def restart_if_new_version(original_content, original_stat):
+  # Only read the file when it has been touched since we last looked.
+  new_stat = get_own_file_stat()
+  if new_stat == original_stat:
+    return original_stat
   new_content = get_own_file_content()
   log('Lengths %s %s' % (len(original_content), len(new_content)))
   log('is master %s ' % utils.is_master())
@@ -183,11 +212,11 @@ def restart_if_new_version(original_content):
   if new_content != original_content:
     log('Restarting tools/internal_test.py, content changed')
     os.execv(sys.argv[0], sys.argv)
+  return new_stat
 
 def ensure_git_clean():
   # Ensure clean git repo.
-  diff = subprocess.check_output(['git', 'diff'])
-  if len(diff) > 0:
+  if subprocess.call(['git', 'diff', '--quiet', '--no-ext-diff']) != 0:
     log('Local modifications to the git repo, exiting')
     sys.exit(1)
 
@@ -197,10 +226,16 @@ def git_pull():
   subprocess.check_call(['git', 'pull'])
   return utils.get_HEAD_sha1()
 
+def git_has_commit(git_hash):
+  with open(os.devnull, 'w') as devnull:
+    return subprocess.call(['git', 'cat-file', '-e', '%s^{commit}' % git_hash],
+                           stderr=devnull) == 0
+
 def git_checkout(git_hash):
   ensure_git_clean()
-  # Ensure that we are up to date to get the commit.
-  git_pull()
+  # Ensure that we are up to date to get the commit, unless we already have it.
+  if not git_has_commit(git_hash):
+    git_pull()
   exitcode = subprocess.call(['git', 'checkout', git_hash])
   if exitcode != 0:
     return None
@@ -212,25 +247,26 @@ def get_test_result_dir():
 def get_sha_destination(sha):
   return os.path.join(get_test_result_dir(), sha)
 
-def archive_status(failed):
-  gs_destination = 'gs://%s' % get_sha_destination(utils.get_HEAD_sha1())
+def archive_status(git_hash, failed):
+  gs_destination = 'gs://%s' % get_sha_destination(git_hash)
   utils.archive_value('status', gs_destination, failed)
 
 def get_status(sha):
   gs_destination = 'gs://%s/status' % get_sha_destination(sha)
   return utils.cat_file_on_cloud_storage(gs_destination)
 
-def archive_log(stdout, stderr, exitcode, timed_out, cmd):
-  sha = utils.get_HEAD_sha1()
+def archive_log(git_hash, stdout, stderr, exitcode, timed_out, cmd):
   cmd_dir = cmd.replace(' ', '_').replace('/', '_')
-  destination = os.path.join(get_sha_destination(sha), cmd_dir)
+  destination = os.path.join(get_sha_destination(git_hash), cmd_dir)
   gs_destination = 'gs://%s' % destination
   url = 'https://storage.cloud.google.com/%s' % destination
   log('Archiving logs to: %s' % gs_destination)
-  utils.archive_value(EXITCODE, gs_destination, exitcode)
-  utils.archive_value(TIMED_OUT, gs_destination, timed_out)
-  utils.archive_file(STDOUT, gs_destination, stdout)
-  utils.archive_file(STDERR, gs_destination, stderr)
+  with utils.TempDir() as temp:
+    meta = os.path.join(temp, META)
+    with open(meta, 'w') as f:
+      json.dump({EXITCODE: exitcode, TIMED_OUT: timed_out}, f)
+    # The log files are named STDOUT and STDERR, see execute.
+    utils.archive_files(gs_destination, [meta, stdout, stderr])
   log('Logs available at: %s' % url)
 
 def get_magic_file_base_path():
@@ -239,8 +275,13 @@ def get_magic_file_base_path():
 def get_magic_file_gs_path(name):
   return '%s/%s' % (get_magic_file_base_path(), name)
 
-def get_magic_file_exists(name):
-  return utils.file_exists_on_cloud_storage(get_magic_file_gs_path(name))
+def list_magic_files():
+  # A single listing of the magic directory instead of one request per file.
+  # Listing fails if there are no magic files at all.
+  listing = utils.ls_files_on_cloud_storage(get_magic_file_base_path(),
+                                            ignore_errors=True)
+  return set(os.path.basename(entry)
+             for entry in listing.strip().split('\n') if entry)
 
 def delete_magic_file(name):
   utils.delete_file_from_cloud_storage(get_magic_file_gs_path(name))
@@ -248,38 +289,73 @@ def delete_magic_file(name):
 def put_magic_file(name, sha):
   utils.archive_value(name, get_magic_file_base_path(), sha)
 
+# Pool for the magic file updates, see replace_magic_file. Its threads live
+# as long as the process so that they keep their cloud storage clients.
+_magic_file_pool = None
+
+def replace_magic_file(old_name, new_name, sha):
+  # Nobody waits for the old file to disappear, so the put and the delete can
+  # be done concurrently.
+  global _magic_file_pool
+  if _magic_file_pool is None:
+    _magic_file_pool = ThreadPool(2)
+  results = [
+      _magic_file_pool.apply_async(put_magic_file, (new_name, sha)),
+      _magic_file_pool.apply_async(delete_magic_file, (old_name,))]
+  for result in results:
+    result.get()
+
 def get_magic_file_content(name, ignore_errors=False):
   return utils.cat_file_on_cloud_storage(get_magic_file_gs_path(name),
                                          ignore_errors=ignore_errors)
 
-def print_magic_file_state():
+def print_magic_file_state(existing):
   log('Magic file status:')
   for magic in ALL_MAGIC:
-    if get_magic_file_exists(magic):
+    if magic in existing:
       content = get_magic_file_content(magic, ignore_errors=True)
       log('%s content: %s' % (magic, content))
 
 def fetch_and_print_logs(hash):
   gs_base = 'gs://%s' % get_sha_destination(hash)
-  listing = utils.ls_files_on_cloud_storage(gs_base).strip().split('\n')
-  for entry in listing:
-    if not entry.endswith('/status'): # Ignore the overall status file
-      for to_print in [EXITCODE, TIMED_OUT, STDERR, STDOUT]:
-        gs_location = '%s%s' % (entry, to_print)
-        value = utils.cat_file_on_cloud_storage(gs_location)
+  with utils.TempDir() as temp:
+    # Fetch all logs in one parallel download rather than file by file.
+    utils.download_dir_from_cloud_storage(gs_base, temp)
+    local_base = os.path.join(temp, hash)
+    for entry in sorted(os.listdir(local_base)):
+      entry_dir = os.path.join(local_base, entry)
+      if not os.path.isdir(entry_dir): # Ignore the overall status file
+        continue
+      meta_file = os.path.join(entry_dir, META)
+      if os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+          meta = json.load(f)
+      else:
+        # Logs archived before META was introduced have a file per value.
+        meta = {}
+        for name in [EXITCODE, TIMED_OUT]:
+          with open(os.path.join(entry_dir, name), 'r') as f:
+            meta[name] = f.read()
+      for to_print in [EXITCODE, TIMED_OUT]:
+        print('\n\n%s had value:\n%s' % (to_print, meta[to_print]))
+      for to_print in [STDERR, STDOUT]:
+        with open(os.path.join(entry_dir, to_print), 'r') as f:
+          value = f.read()
         print('\n\n%s had value:\n%s' % (to_print, value))
   print("\n\nPrinting find-min-xmx ranges for apps")
   run_on_app.print_min_xmx_ranges_for_hash(hash, 'r8', 'lib')
 
 def run_bot():
-  print_magic_file_state()
+  existing = list_magic_files()
+  print_magic_file_state(existing)
   # Ensure that there is nothing currently scheduled (broken/stopped run)
   for magic in ALL_MAGIC:
-    if get_magic_file_exists(magic):
+    if magic in existing:
       log('ERROR: Synchronizing file %s exists, cleaning up' % magic)
       delete_magic_file(magic)
-  print_magic_file_state()
-  assert not get_magic_file_exists(READY_FOR_TESTING)
+  existing = list_magic_files()
+  print_magic_file_state(existing)
+  assert READY_FOR_TESTING not in existing
   git_hash = utils.get_HEAD_sha1()
   put_magic_file(READY_FOR_TESTING, git_hash)
   begin = time.time()
@@ -287,14 +363,17 @@ def run_bot():
     if time.time() - begin > BOT_RUN_TIMEOUT:
       log('Timeout exceeded: http://go/internal-r8-doc')
       raise Exception('Bot timeout')
-    if get_magic_file_exists(TESTING_COMPLETE):
-      if get_magic_file_content(TESTING_COMPLETE) == git_hash:
+    # A single listing per poll, used for both the check and the logging.
+    existing = list_magic_files()
+    if TESTING_COMPLETE in existing:
+      content = get_magic_file_content(TESTING_COMPLETE)
+      if content == git_hash:
         break
       else:
         raise Exception('Non matching git hashes %s and %s' % (
-            get_magic_file_content(TESTING_COMPLETE), git_hash))
+            content, git_hash))
     log('Still waiting for test result')
-    print_magic_file_state()
+    print_magic_file_state(existing)
     time.sleep(PULL_DELAY)
   total_time = time.time()-begin
   log('Done running test for %s in %ss' % (git_hash, total_time))
@@ -308,39 +387,41 @@ def run_bot():
 
 def run_continuously():
   # If this script changes, we will restart ourselves
+  own_stat = get_own_file_stat()
   own_content = get_own_file_content()
   while True:
-    restart_if_new_version(own_content)
-    print_magic_file_state()
-    if get_magic_file_exists(READY_FOR_TESTING):
+    own_stat = restart_if_new_version(own_content, own_stat)
+    existing = list_magic_files()
+    print_magic_file_state(existing)
+    if READY_FOR_TESTING in existing:
       git_hash = get_magic_file_content(READY_FOR_TESTING)
       checked_out = git_checkout(git_hash)
       if not checked_out:
         # Gerrit change, we don't run these on internal.
-        archive_status(0)
-        put_magic_file(TESTING_COMPLETE, git_hash)
-        delete_magic_file(READY_FOR_TESTING)
+        archive_status(git_hash, 0)
+        replace_magic_file(READY_FOR_TESTING, TESTING_COMPLETE, git_hash)
         continue
       # If the script changed, we need to restart now to get correct commands
       # Note that we have not removed the READY_FOR_TESTING yet, so if we
       # execv we will pick up the same version.
-      restart_if_new_version(own_content)
+      own_stat = restart_if_new_version(own_content, own_stat)
       # Sanity check, if this does not succeed stop.
       if checked_out != git_hash:
         log('Inconsistent state: %s %s' % (git_hash, checked_out))
         sys.exit(1)
-      put_magic_file(TESTING, git_hash)
-      delete_magic_file(READY_FOR_TESTING)
+      replace_magic_file(READY_FOR_TESTING, TESTING, git_hash)
       log('Running with hash: %s' % git_hash)
       exitcode = run_once(archive=True)
       log('Running finished with exit code %s' % exitcode)
-      put_magic_file(TESTING_COMPLETE, git_hash)
-      delete_magic_file(TESTING)
+      replace_magic_file(TESTING, TESTING_COMPLETE, git_hash)
+      # Check for new work right away rather than sleeping after a long run.
+      continue
     time.sleep(PULL_DELAY)
 
-def handle_output(archive, stderr, stdout, exitcode, timed_out, cmd):
+def handle_output(
+    archive, git_hash, stderr, stdout, exitcode, timed_out, cmd):
   if archive:
-    archive_log(stdout, stderr, exitcode, timed_out, cmd)
+    archive_log(git_hash, stdout, stderr, exitcode, timed_out, cmd)
   else:
     print 'Execution of %s resulted in:' % cmd
     print 'exit code: %s ' % exitcode
@@ -350,43 +431,63 @@ def handle_output(archive, stderr, stdout, exitcode, timed_out, cmd):
     with open(stdout, 'r') as f:
       print 'stdout: %s' % f.read()
 
-def execute(cmd, archive, env=None):
-  if cmd == []:
-    return
-
+def execute(cmd, archive, git_hash, env=None):
   utils.PrintCmd(cmd)
   with utils.TempDir() as temp:
     try:
       stderr_fd = None
       stdout_fd = None
       exitcode = 0
-      stderr = os.path.join(temp, 'stderr')
+      stderr = os.path.join(temp, STDERR)
       stderr_fd = open(stderr, 'w')
-      stdout = os.path.join(temp, 'stdout')
+      stdout = os.path.join(temp, STDOUT)
       stdout_fd = open(stdout, 'w')
       popen = subprocess.Popen(cmd,
-                               bufsize=1024*1024*10,
                                stdout=stdout_fd,
                                stderr=stderr_fd,
                                env=env)
-      begin = time.time()
-      timed_out = False
-      while popen.poll() == None:
-        if time.time() - begin > RUN_TIMEOUT:
-          popen.terminate()
-          timed_out = True
-        time.sleep(2)
-      exitcode = popen.returncode
+      timed_out_event = threading.Event()
+      def terminate():
+        timed_out_event.set()
+        popen.terminate()
+      timer = threading.Timer(RUN_TIMEOUT, terminate)
+      timer.start()
+      try:
+        exitcode = popen.wait()
+      finally:
+        timer.cancel()
+      timed_out = timed_out_event.is_set()
     finally:
       if stderr_fd:
         stderr_fd.close()
       if stdout_fd:
         stdout_fd.close()
       if exitcode != 0:
-        handle_output(archive, stderr, stdout, popen.returncode,
+        handle_output(archive, git_hash, stderr, stdout, popen.returncode,
                       timed_out, ' '.join(cmd))
     return exitcode
 
+def check_java_version(archive, git_hash):
+  # Report a bad JVM as a failed command rather than raising out of the
+  # tester loop, which would leave the bot waiting for a result.
+  try:
+    utils.check_java_version()
+    return False
+  except Exception as e:
+    with utils.TempDir() as temp:
+      stderr = os.path.join(temp, STDERR)
+      with open(stderr, 'w') as f:
+        f.write(str(e))
+      stdout = os.path.join(temp, STDOUT)
+      open(stdout, 'w').close()
+      handle_output(archive, git_hash, stderr, stdout, 1, False,
+                    'check_java_version')
+    return True
+
+def execute_all(cmds, archive, git_hash, env):
+  # Run all commands, also when one of them fails.
+  return any([execute(cmd, archive, git_hash, env) for cmd in cmds])
+
 def run_once(archive):
   failed = False
   git_hash = utils.get_HEAD_sha1()
@@ -394,14 +495,31 @@ def run_once(archive):
   env = os.environ.copy()
   # Bot does not have a lot of memory.
   env['R8_GRADLE_CORES_PER_FORK'] = '16'
-  failed = any([execute(cmd, archive, env) for cmd in TEST_COMMANDS])
+  # Keep the logs of the python commands complete up to the point of a crash.
+  env['PYTHONUNBUFFERED'] = '1'
+  failed = execute_all(TEST_COMMANDS, archive, git_hash, env)
+  # The benchmark commands are run with --ignore-java-version.
+  if check_java_version(archive, git_hash):
+    failed = True
+  else:
+    pool = ThreadPool(BENCHMARK_WORKERS)
+    try:
+      benchmarks_failed = pool.map(
+          lambda cmds: execute_all(cmds, archive, git_hash, env),
+          BENCHMARK_COMMANDS)
+    finally:
+      pool.close()
+      pool.join()
+    failed = failed or any(benchmarks_failed)
   # Gradle daemon occasionally leaks memory, stop it.
   gradle.RunGradle(['--stop'])
-  archive_status(1 if failed else 0)
+  archive_status(git_hash, 1 if failed else 0)
   return failed
 
 def Main():
   (options, args) = ParseOptions()
+  if options.storage_client:
+    utils.enable_storage_client()
   if options.continuous:
     run_continuously()
   elif options.bot:
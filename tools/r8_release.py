@@ -3,34 +3,73 @@
 # for details. All rights reserved. Use of this source code is governed by a
 # BSD-style license that can be found in the LICENSE file.
 
+from __future__ import print_function
+
 import argparse
-import datetime
 import os.path
 import re
 import shutil
 import subprocess
 import sys
-import urllib
+import time
 
-import update_prebuilds_in_android
 import utils
 
+try:
+  input = raw_input
+except NameError:
+  # Python 3.
+  pass
+
 R8_DEV_BRANCH = '2.0'
 R8_VERSION_FILE = os.path.join(
     'src', 'main', 'java', 'com', 'android', 'tools', 'r8', 'Version.java')
 THIS_FILE_RELATIVE = os.path.join('tools', 'r8_release.py')
+VERSION_LABEL_PATTERN = re.compile(
+    r'LABEL = "%s\.(\d+)-dev";' % re.escape(R8_DEV_BRANCH))
+DEV_BRANCH_PATTERN = re.compile(r"^R8_DEV_BRANCH = '(\d+).(\d+)'", re.MULTILINE)
+# The changed lines in a diff that the version and branch changes may touch.
+VERSION_DIFF_LINE_PATTERN = re.compile(r'^[-+]  .*$', re.MULTILINE)
+BRANCH_DIFF_LINE_PATTERN = re.compile(r'^[-+]R8.*$', re.MULTILINE)
+# The version and the date in the google3 METADATA file.
+METADATA_VERSION_PATTERN = re.compile(r'[1-9]\.[0-9]{1,2}\.[0-9]{1,3}-dev')
+METADATA_DATE_PATTERN = re.compile(r'\{ year.*\}')
+RELEASE_CACHE_DIR = os.path.join(utils.USER_HOME, '.cache', 'r8_release')
+REPO_SOURCE_MIRROR = os.path.join(RELEASE_CACHE_DIR, 'mirror.git')
+# Only branches and tags are mirrored, not the review refs of the host.
+REPO_SOURCE_MIRROR_REFSPECS = [
+  '+refs/heads/*:refs/heads/*',
+  '+refs/tags/*:refs/tags/*',
+]
+# With --skip-recent-sync, do not repo sync a checkout again within this many
+# seconds.
+SYNC_STAMP_MAX_AGE = 24 * 60 * 60
+# Default number of parallel fetches for repo sync.
+JOBS_DEFAULT = 16
+
+
+def clone_repo_source(checkout):
+  # Keep a local mirror so that each release only fetches the new objects.
+  if not os.path.isdir(REPO_SOURCE_MIRROR):
+    subprocess.check_call(['git', 'init', '--bare', REPO_SOURCE_MIRROR])
+  subprocess.check_call([
+    'git', '--git-dir', REPO_SOURCE_MIRROR, 'fetch', '--prune',
+    utils.REPO_SOURCE] + REPO_SOURCE_MIRROR_REFSPECS)
+  subprocess.check_call([
+    'git', 'clone', '--reference', REPO_SOURCE_MIRROR, utils.REPO_SOURCE,
+    checkout])
 
 
 def prepare_release(args):
   if args.version:
-    print "Cannot manually specify version when making a dev release."
+    print("Cannot manually specify version when making a dev release.")
     sys.exit(1)
 
   def make_release(args):
     commithash = args.dev_release
 
     with utils.TempDir() as temp:
-      subprocess.check_call(['git', 'clone', utils.REPO_SOURCE, temp])
+      clone_repo_source(temp)
       with utils.ChangedWorkingDirectory(temp):
         subprocess.check_call([
           'git',
@@ -40,32 +79,28 @@ def prepare_release(args):
           'dev-release'])
 
         # Compute the current and new version on the branch.
-        result = None
-        for line in open(R8_VERSION_FILE, 'r'):
-          result = re.match(
-              r'.*LABEL = "%s\.(\d+)\-dev";' % R8_DEV_BRANCH, line)
-          if result:
-            break
+        with open(R8_VERSION_FILE, 'r') as version_file:
+          result = VERSION_LABEL_PATTERN.search(version_file.read())
         if not result or not result.group(1):
-          print 'Failed to find version label matching %s(\d+)-dev'\
-                % R8_DEV_BRANCH
+          print(r'Failed to find version label matching %s(\d+)-dev'
+                % R8_DEV_BRANCH)
           sys.exit(1)
         try:
           patch_version = int(result.group(1))
         except ValueError:
-          print 'Failed to convert version to integer: %s' % result.group(1)
+          print('Failed to convert version to integer: %s' % result.group(1))
 
         old_version = '%s.%s-dev' % (R8_DEV_BRANCH, patch_version)
         version = '%s.%s-dev' % (R8_DEV_BRANCH, patch_version + 1)
 
         # Verify that the merge point from master is not empty.
         merge_diff_output = subprocess.check_output([
-          'git', 'diff', 'HEAD..%s' % commithash])
+          'git', 'diff', 'HEAD..%s' % commithash], universal_newlines=True)
         other_diff = version_change_diff(
             merge_diff_output, old_version, "master")
         if not other_diff:
-          print 'Merge point from master (%s)' % commithash, \
-            'is the same as exiting release (%s).' % old_version
+          print('Merge point from master (%s)' % commithash,
+            'is the same as exiting release (%s).' % old_version)
           sys.exit(1)
 
         # Merge the desired commit from master on to the branch.
@@ -79,20 +114,19 @@ def prepare_release(args):
           'git', 'commit', '-a', '-m', 'Version %s' % version])
 
         version_diff_output = subprocess.check_output([
-          'git', 'diff', '%s..HEAD' % commithash])
+          'git', 'diff', '%s..HEAD' % commithash], universal_newlines=True)
 
         validate_version_change_diff(version_diff_output, "master", version)
 
         # Double check that we want to push the release.
         if not args.dry_run:
-          input = raw_input('Publish dev release version %s [y/N]:' % version)
-          if input != 'y':
-            print 'Aborting dev release for %s' % version
+          answer = input('Publish dev release version %s [y/N]:' % version)
+          if answer != 'y':
+            print('Aborting dev release for %s' % version)
             sys.exit(1)
 
-        maybe_check_call(args, [
-          'git', 'push', 'origin', 'HEAD:%s' % R8_DEV_BRANCH])
         maybe_tag(args, version)
+        maybe_push_with_tag(args, R8_DEV_BRANCH, version)
 
         return "%s dev version %s from hash %s" % (
           'DryRun: omitted publish of' if args.dry_run else 'Published',
@@ -105,17 +139,23 @@ def prepare_release(args):
 def maybe_tag(args, version):
   maybe_check_call(args, [
     'git', 'tag', '-a', version, '-m', '"%s"' % version])
+
+
+def maybe_push_with_tag(args, branch, version):
+  # Push the branch and the tag in one go, either both or none are updated.
   maybe_check_call(args, [
-    'git', 'push', 'origin', 'refs/tags/%s' % version])
+    'git', 'push', '--atomic', 'origin', 'HEAD:%s' % branch,
+    'refs/tags/%s' % version])
 
 def version_change_diff(diff, old_version, new_version):
   invalid_line = None
-  for line in diff.splitlines():
-    if line.startswith('-  ') and \
-        line != '-  public static final String LABEL = "%s";' % old_version:
-      invalid_line = line
-    elif line.startswith('+  ') and \
-        line != '+  public static final String LABEL = "%s";' % new_version:
+  expected = {
+    '-': '-  public static final String LABEL = "%s";' % old_version,
+    '+': '+  public static final String LABEL = "%s";' % new_version,
+  }
+  for match in VERSION_DIFF_LINE_PATTERN.finditer(diff):
+    line = match.group(0)
+    if line != expected[line[0]]:
       invalid_line = line
   return invalid_line
 
@@ -123,37 +163,84 @@ def version_change_diff(diff, old_version, new_version):
 def validate_version_change_diff(version_diff_output, old_version, new_version):
   invalid = version_change_diff(version_diff_output, old_version, new_version)
   if invalid:
-    print "Unexpected diff:"
-    print "=" * 80
-    print version_diff_output
-    print "=" * 80
+    print("Unexpected diff:")
+    print("=" * 80)
+    print(version_diff_output)
+    print("=" * 80)
     accept_string = 'THE DIFF IS OK!'
-    input = raw_input(
+    answer = input(
       "Accept the additonal diff as part of the release? "
       "Type '%s' to accept: " % accept_string)
-    if input != accept_string:
-      print "You did not type '%s'" % accept_string
-      print 'Aborting dev release for %s' % version
+    if answer != accept_string:
+      print("You did not type '%s'" % accept_string)
+      print('Aborting dev release for %s' % version)
       sys.exit(1)
 
 
 def maybe_check_call(args, cmd):
+  command = ' '.join(cmd)
   if args.dry_run:
-    print 'DryRun:', ' '.join(cmd)
-  else:
-    print ' '.join(cmd)
-    return subprocess.check_call(cmd)
+    print('DryRun:', command)
+    return
+  print(command)
+  return subprocess.check_call(cmd)
 
 
 def update_prebuilds(version, checkout):
+  import update_prebuilds_in_android
   update_prebuilds_in_android.main_download('', True, 'lib', checkout, version)
 
 
+def get_sync_stamp(path):
+  return os.path.join(RELEASE_CACHE_DIR,
+                      'sync-%s.stamp' % os.path.abspath(path).replace('/', '_'))
+
+
+def is_sync_current(path):
+  stamp = get_sync_stamp(path)
+  if not os.path.exists(stamp):
+    return False
+  return time.time() - os.path.getmtime(stamp) < SYNC_STAMP_MAX_AGE
+
+
+def write_sync_stamp(path):
+  utils.makedirs_if_needed(RELEASE_CACHE_DIR)
+  with open(get_sync_stamp(path), 'w') as f:
+    f.write('%s\n' % time.time())
+
+
+# Whether repo upload supports --yes, see repo_upload.
+REPO_UPLOAD_HAS_YES = None
+
+
+def repo_upload():
+  global REPO_UPLOAD_HAS_YES
+  if REPO_UPLOAD_HAS_YES is None:
+    help_output = subprocess.check_output(
+        ['repo', 'upload', '--help'], universal_newlines=True)
+    REPO_UPLOAD_HAS_YES = '--yes' in help_output
+  if REPO_UPLOAD_HAS_YES:
+    subprocess.check_call(['repo', 'upload', '.', '--verify', '--yes'])
+  else:
+    # Older versions of repo ask for confirmation on stdin.
+    process = subprocess.Popen(['repo', 'upload', '.', '--verify'],
+                               stdin=subprocess.PIPE)
+    process.communicate(input=b'y\n')
+    if process.returncode != 0:
+      raise subprocess.CalledProcessError(
+          process.returncode, 'repo upload . --verify')
+
+
 def release_studio_or_aosp(path, options, git_message):
   with utils.ChangedWorkingDirectory(path):
     subprocess.call(['repo', 'abandon', 'update-r8'])
     if not options.no_sync:
-      subprocess.check_call(['repo', 'sync', '-cq', '-j', '16'])
+      if options.skip_recent_sync and is_sync_current(path):
+        print('Skipping repo sync, %s was synced less than a day ago' % path)
+      else:
+        subprocess.check_call(
+            ['repo', 'sync', '-cq', '-j', str(options.jobs)])
+        write_sync_stamp(path)
 
     prebuilts_r8 = os.path.join(path, 'prebuilts', 'r8')
 
@@ -164,9 +251,7 @@ def release_studio_or_aosp(path, options, git_message):
 
     with utils.ChangedWorkingDirectory(prebuilts_r8):
       subprocess.check_call(['git', 'commit', '-a', '-m', git_message])
-      process = subprocess.Popen(['repo', 'upload', '.', '--verify'],
-                                 stdin=subprocess.PIPE)
-      return process.communicate(input='y\n')[0]
+      repo_upload()
 
 
 def prepare_aosp(args):
@@ -174,7 +259,7 @@ def prepare_aosp(args):
   assert os.path.exists(args.aosp), "Could not find AOSP path %s" % args.aosp
 
   def release_aosp(options):
-    print "Releasing for AOSP"
+    print("Releasing for AOSP")
     if options.dry_run:
       return 'DryRun: omitting AOSP release for %s' % options.version
 
@@ -219,7 +304,7 @@ def prepare_studio(args):
                                        % args.studio)
 
   def release_studio(options):
-    print "Releasing for STUDIO"
+    print("Releasing for STUDIO")
     if options.dry_run:
       return 'DryRun: omitting studio release for %s' % options.version
 
@@ -231,59 +316,99 @@ def prepare_studio(args):
   return release_studio
 
 
-def g4_cp(old, new, file):
-  subprocess.check_call('g4 cp {%s,%s}/%s' % (old, new, file), shell=True)
-
-
-def g4_open(file):
-  subprocess.check_call('g4 open %s' % file, shell=True)
+def g4_open(files):
+  subprocess.check_call(['g4', 'open'] + files)
 
 
 def g4_add(files):
-  subprocess.check_call(' '.join(['g4', 'add'] + files), shell=True)
+  subprocess.check_call(['g4', 'add'] + files)
 
 
 def g4_change(version, r8version):
-  return subprocess.check_output(
-      'g4 change --desc "Update R8 to version %s %s\n\n'
+  return subprocess.check_output([
+      'g4', 'change', '--desc',
+      'Update R8 to version %s %s\n\n'
       'IGNORE_COMPLIANCELINT=D8 and R8 are built externally to produce a fully '
-      'tested R8lib"' % (version, r8version),
-      shell=True)
+      'tested R8lib' % (version, r8version)], universal_newlines=True)
+
+
+# Compiled sed() patterns.
+SED_PATTERNS = {}
 
 
 def sed(pattern, replace, path):
   with open(path, "r") as sources:
-    lines = sources.readlines()
-  with open(path, "w") as sources:
-    for line in lines:
-      sources.write(re.sub(pattern, replace, line))
+    content = sources.read()
+  # None of the patterns span lines, so substitute in the whole file at once.
+  if hasattr(pattern, 'sub'):
+    # Already compiled.
+    content = pattern.sub(replace, content)
+  elif is_literal(pattern):
+    content = content.replace(pattern, replace)
+  else:
+    if pattern not in SED_PATTERNS:
+      SED_PATTERNS[pattern] = re.compile(pattern)
+    content = SED_PATTERNS[pattern].sub(replace, content)
+  # Write to a temporary file and rename it to never leave a partial file.
+  tmp = path + '.tmp'
+  with open(tmp, "w") as sources:
+    sources.write(content)
+  shutil.copymode(path, tmp)
+  os.rename(tmp, path)
 
 
-def download_file(version, file, dst):
-  urllib.urlretrieve(
-      ('http://storage.googleapis.com/r8-releases/raw/%s/%s' % (version, file)),
-      dst)
+def is_literal(pattern):
+  return not any(c in pattern for c in '\\.^$*+?{}[]|()')
 
 
-def blaze_run(target):
+def download_file(version, file, dst):
+  try:
+    from urllib.request import urlopen
+  except ImportError:
+    # Python 2.
+    from urllib2 import urlopen
+  response = urlopen(
+      'http://storage.googleapis.com/r8-releases/raw/%s/%s' % (version, file))
+  try:
+    with open(dst, 'wb') as output:
+      shutil.copyfileobj(response, output, 1024 * 1024)
+  finally:
+    response.close()
+
+
+def download_files(version, files):
+  from multiprocessing.pool import ThreadPool
+  # The downloads are independent of each other, fetch them concurrently.
+  pool = ThreadPool(len(files))
+  try:
+    pool.map(lambda file_and_dst: download_file(version, *file_and_dst), files)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def blaze_run(args):
   return subprocess.check_output(
-      'blaze run %s' % target, shell=True, stderr=subprocess.STDOUT)
+      ['blaze', 'run'] + args, stderr=subprocess.STDOUT,
+      universal_newlines=True)
 
 
 def prepare_google3(args):
   assert args.version
   # Check if an existing client exists.
-  if ':update-r8:' in subprocess.check_output('g4 myclients', shell=True):
-    print "Remove the existing 'update-r8' client before continuing."
+  if ':update-r8:' in subprocess.check_output(
+      ['g4', 'myclients'], universal_newlines=True):
+    print("Remove the existing 'update-r8' client before continuing.")
     sys.exit(1)
 
   def release_google3(options):
-    print "Releasing for Google 3"
+    import datetime
+    print("Releasing for Google 3")
     if options.dry_run:
       return 'DryRun: omitting g3 release for %s' % options.version
 
     google3_base = subprocess.check_output(
-        ['p4', 'g4d', '-f', 'update-r8']).rstrip()
+        ['p4', 'g4d', '-f', 'update-r8'], universal_newlines=True).rstrip()
     third_party_r8 = os.path.join(google3_base, 'third_party', 'java', 'r8')
 
     # Check if new version folder is already created
@@ -295,11 +420,9 @@ def prepare_google3(args):
       shutil.rmtree(new_version_path)
 
     # Remove old version
-    old_versions = []
-    for name in os.listdir(third_party_r8):
-      if os.path.isdir(os.path.join(third_party_r8, name)):
-        old_versions.append(name)
-    old_versions.sort()
+    old_versions = sorted(
+        name for name in os.listdir(third_party_r8)
+        if os.path.isdir(os.path.join(third_party_r8, name)))
 
     if len(old_versions) >= 2:
       shutil.rmtree(os.path.join(third_party_r8, old_versions[0]))
@@ -312,40 +435,43 @@ def prepare_google3(args):
     os.mkdir(new_version_path)
 
     with utils.ChangedWorkingDirectory(third_party_r8):
-      g4_cp(old_version, new_version, 'BUILD')
-      g4_cp(old_version, new_version, 'LICENSE')
-      g4_cp(old_version, new_version, 'METADATA')
+      # Copy in process rather than with 'g4 cp', the files are added below.
+      # Hard links are not used: sed replaces the files anyway and the chmod
+      # below would also make the files of the old version writable.
+      template_files = ['BUILD', 'LICENSE', 'METADATA']
+      for file in template_files:
+        shutil.copyfile(os.path.join(old_version, file),
+                        os.path.join(new_version, file))
 
       with utils.ChangedWorkingDirectory(new_version_path):
         # update METADATA
-        g4_open('METADATA')
-        sed(r'[1-9]\.[0-9]{1,2}\.[0-9]{1,3}-dev',
+        sed(METADATA_VERSION_PATTERN,
             options.version,
             os.path.join(new_version_path, 'METADATA'))
-        sed(r'\{ year.*\}',
+        sed(METADATA_DATE_PATTERN,
             ('{ year: %i month: %i day: %i }'
              % (today.year, today.month, today.day))
             , os.path.join(new_version_path, 'METADATA'))
 
         # update BUILD (is not necessary from v20190923)
-        g4_open('BUILD')
         sed(old_version, new_version, os.path.join(new_version_path, 'BUILD'))
 
         # download files
-        download_file(options.version, 'r8-full-exclude-deps.jar', 'r8.jar')
-        download_file(options.version, 'r8-src.jar', 'r8-src.jar')
-        download_file(options.version, 'r8lib-exclude-deps.jar', 'r8lib.jar')
-        download_file(
-            options.version, 'r8lib-exclude-deps.jar.map', 'r8lib.jar.map')
-        g4_add(['r8.jar', 'r8-src.jar', 'r8lib.jar', 'r8lib.jar.map'])
+        download_files(options.version, [
+            ('r8-full-exclude-deps.jar', 'r8.jar'),
+            ('r8-src.jar', 'r8-src.jar'),
+            ('r8lib-exclude-deps.jar', 'r8lib.jar'),
+            ('r8lib-exclude-deps.jar.map', 'r8lib.jar.map')])
+        g4_add(template_files
+               + ['r8.jar', 'r8-src.jar', 'r8lib.jar', 'r8lib.jar.map'])
 
-      subprocess.check_output('chmod u+w %s/*' % new_version, shell=True)
+      subprocess.check_call('chmod u+w %s/*' % new_version, shell=True)
 
-      g4_open('BUILD')
+      g4_open(['BUILD'])
       sed(old_version, new_version, os.path.join(third_party_r8, 'BUILD'))
 
     with utils.ChangedWorkingDirectory(google3_base):
-      blaze_result = blaze_run('//third_party/java/r8:d8 -- --version')
+      blaze_result = blaze_run(['//third_party/java/r8:d8', '--', '--version'])
 
       assert options.version in blaze_result
 
@@ -356,14 +482,14 @@ def prepare_google3(args):
 
 def branch_change_diff(diff, old_version, new_version):
   invalid_line = None
-  for line in diff.splitlines():
-    if line.startswith('-R8') and \
-        line != "-R8_DEV_BRANCH = '%s'" % old_version:
-      print line
-      invalid_line = line
-    elif line.startswith('+R8') and \
-        line != "+R8_DEV_BRANCH = '%s'" % new_version:
-      print line
+  expected = {
+    '-': "-R8_DEV_BRANCH = '%s'" % old_version,
+    '+': "+R8_DEV_BRANCH = '%s'" % new_version,
+  }
+  for match in BRANCH_DIFF_LINE_PATTERN.finditer(diff):
+    line = match.group(0)
+    if line != expected[line[0]]:
+      print(line)
       invalid_line = line
   return invalid_line
 
@@ -371,15 +497,15 @@ def branch_change_diff(diff, old_version, new_version):
 def validate_branch_change_diff(version_diff_output, old_version, new_version):
   invalid = branch_change_diff(version_diff_output, old_version, new_version)
   if invalid:
-    print
-    print "The diff for the branch change in tools/release.py is not as expected:"
-    print
-    print "=" * 80
-    print version_diff_output
-    print "=" * 80
-    print
-    print "Validate the uploaded CL before landing."
-    print
+    print()
+    print("The diff for the branch change in tools/release.py is not as expected:")
+    print()
+    print("=" * 80)
+    print(version_diff_output)
+    print("=" * 80)
+    print()
+    print("Validate the uploaded CL before landing.")
+    print()
 
 
 def prepare_branch(args):
@@ -391,7 +517,7 @@ def prepare_branch(args):
   semver = utils.check_basic_semver_version(
     branch_version, ", release branch version should be x.y", 2)
   if not semver.larger_than(current_semver):
-    print ('New branch version "'
+    print('New branch version "'
       + branch_version
       + '" must be strictly larger than the current "'
       + R8_DEV_BRANCH
@@ -400,7 +526,7 @@ def prepare_branch(args):
 
   def make_branch(options):
     with utils.TempDir() as temp:
-      subprocess.check_call(['git', 'clone', utils.REPO_SOURCE, temp])
+      clone_repo_source(temp)
       with utils.ChangedWorkingDirectory(temp):
         subprocess.check_call(['git', 'branch', branch_version, commithash])
 
@@ -418,35 +544,30 @@ def prepare_branch(args):
           'git', 'commit', '-a', '-m', 'Version %s' % full_version])
 
         version_diff_output = subprocess.check_output([
-          'git', 'diff', '%s..HEAD' % commithash])
+          'git', 'diff', '%s..HEAD' % commithash], universal_newlines=True)
 
         validate_version_change_diff(version_diff_output, old_version, full_version)
 
         # Double check that we want to create a new release branch.
         if not options.dry_run:
-          input = raw_input('Create new branch for %s [y/N]:' % branch_version)
-          if input != 'y':
-            print 'Aborting new branch for %s' % branch_version
+          answer = input('Create new branch for %s [y/N]:' % branch_version)
+          if answer != 'y':
+            print('Aborting new branch for %s' % branch_version)
             sys.exit(1)
 
-        maybe_check_call(options, [
-          'git', 'push', 'origin', 'HEAD:%s' % branch_version])
         maybe_tag(options, full_version)
+        maybe_push_with_tag(options, branch_version, full_version)
 
-        print ('Updating tools/r8_release.py to make new dev releases on %s'
+        print('Updating tools/r8_release.py to make new dev releases on %s'
           % branch_version)
 
         subprocess.check_call(['git', 'new-branch', 'update-release-script'])
 
         # Check this file for the setting of the current dev branch.
-        result = None
-        for line in open(THIS_FILE_RELATIVE, 'r'):
-          result = re.match(
-              r"^R8_DEV_BRANCH = '(\d+).(\d+)'", line)
-          if result:
-            break
+        with open(THIS_FILE_RELATIVE, 'r') as this_file:
+          result = DEV_BRANCH_PATTERN.search(this_file.read())
         if not result or not result.group(1):
-          print 'Failed to find version label in %s' % THIS_FILE_RELATIVE
+          print('Failed to find version label in %s' % THIS_FILE_RELATIVE)
           sys.exit(1)
 
         # Update this file with the new dev branch.
@@ -458,16 +579,17 @@ def prepare_branch(args):
             'Prepare %s for branch %s' % (THIS_FILE_RELATIVE, branch_version)
         subprocess.check_call(['git', 'commit', '-a', '-m', message])
 
-        branch_diff_output = subprocess.check_output(['git', 'diff', 'HEAD~'])
+        branch_diff_output = subprocess.check_output(
+          ['git', 'diff', 'HEAD~'], universal_newlines=True)
 
         validate_branch_change_diff(
           branch_diff_output, R8_DEV_BRANCH, branch_version)
 
         maybe_check_call(options, ['git', 'cl', 'upload', '-f', '-m', message])
 
-        print
-        print 'Make sure to send out the branch change CL for review.'
-        print
+        print()
+        print('Make sure to send out the branch change CL for review.')
+        print()
 
   return make_branch
 
@@ -489,6 +611,17 @@ def parse_options():
                       default=False,
                       action='store_true',
                       help='Do not sync repos before uploading')
+  result.add_argument('--skip-recent-sync', '--skip_recent_sync',
+                      default=False,
+                      action='store_true',
+                      help='Do not sync repos that were synced less than a '
+                           'day ago. The upload is then based on the state '
+                           'of that sync')
+  result.add_argument('--jobs', '-j',
+                      type=int,
+                      default=JOBS_DEFAULT,
+                      help='Number of parallel fetches for repo sync, '
+                           'defaults to %s' % JOBS_DEFAULT)
   result.add_argument('--bug',
                       metavar=('<bug(s)>'),
                       default=[],
@@ -512,11 +645,11 @@ def parse_options():
                       help='Only perform non-commiting tasks and print others.')
   args = result.parse_args()
   if args.version and not 'dev' in args.version and args.bug == []:
-    print "When releasing a release version add the list of bugs by using '--bug'"
+    print("When releasing a release version add the list of bugs by using '--bug'")
     sys.exit(1)
 
   if args.version and not 'dev' in args.version and args.google3:
-    print "You should not roll a release version into google 3"
+    print("You should not roll a release version into google 3")
     sys.exit(1)
 
   return args
@@ -528,13 +661,13 @@ def main():
 
   if args.new_dev_branch:
     if args.google3 or args.studio or args.aosp:
-      print 'Cannot create a branch and roll at the same time.'
+      print('Cannot create a branch and roll at the same time.')
       sys.exit(1)
     targets_to_run.append(prepare_branch(args))
 
   if args.dev_release:
     if args.google3 or args.studio or args.aosp:
-      print 'Cannot create a dev release and roll at the same time.'
+      print('Cannot create a dev release and roll at the same time.')
       sys.exit(1)
     targets_to_run.append(prepare_release(args))
 
@@ -552,13 +685,13 @@ def main():
   for target_closure in targets_to_run:
     final_results.append(target_closure(args))
 
-  print '\n\n**************************************************************'
-  print 'PRINTING SUMMARY'
-  print '**************************************************************\n\n'
+  print('\n\n**************************************************************')
+  print('PRINTING SUMMARY')
+  print('**************************************************************\n\n')
 
   for result in final_results:
     if result is not None:
-      print result
+      print(result)
 
 
 if __name__ == '__main__':
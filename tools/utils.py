@@ -13,6 +13,7 @@ import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import zipfile
 
 import defines
@@ -103,11 +104,73 @@ USER_HOME = os.path.expanduser('~')
 
 R8_TEST_RESULTS_BUCKET = 'r8-test-results'
 
+# Per thread google cloud storage clients, see get_storage_client. The
+# library is only imported by enable_storage_client.
+storage = None
+gcs_exceptions = None
+_use_storage_client = False
+_storage_clients = threading.local()
+
+def enable_storage_client():
+  # Starting gsutil costs a new python process for every operation, so
+  # scripts polling cloud storage can opt in to a long lived client instead.
+  # Everything else keeps using gsutil and its own authentication.
+  global storage, gcs_exceptions, _use_storage_client
+  try:
+    from google.api_core import exceptions as gcs_exceptions
+    from google.cloud import storage
+  except ImportError:
+    print('The google cloud storage library is not available, using gsutil')
+    return
+  _use_storage_client = True
+
+def get_storage_client():
+  global _use_storage_client
+  if not _use_storage_client:
+    return None
+  client = getattr(_storage_clients, 'client', None)
+  if client is None:
+    try:
+      client = storage.Client()
+    except Exception as e:
+      print('Could not create cloud storage client, using gsutil: %s' % e)
+      _use_storage_client = False
+      return None
+    _storage_clients.client = client
+  return client
+
+def split_cloud_storage_path(destination):
+  assert destination.startswith('gs://'), destination
+  (bucket, _, name) = destination[len('gs://'):].partition('/')
+  return (bucket, name)
+
 def archive_file(name, gs_dir, src_file):
   gs_file = '%s/%s' % (gs_dir, name)
+  client = get_storage_client()
+  if client:
+    # Streams the file to cloud storage, no gsutil process needed.
+    (bucket, path) = split_cloud_storage_path(gs_file)
+    client.bucket(bucket).blob(path).upload_from_filename(src_file)
+    return
   upload_file_to_cloud_storage(src_file, gs_file, public_read=False)
 
+def archive_files(gs_dir, src_files):
+  # Archive several files, keeping their names, in a single upload.
+  client = get_storage_client()
+  if client:
+    for src_file in src_files:
+      archive_file(os.path.basename(src_file), gs_dir, src_file)
+    return
+  cmd = ['gsutil.py', '-m', 'cp'] + src_files + ['%s/' % gs_dir]
+  PrintCmd(cmd)
+  subprocess.check_call(cmd)
+
 def archive_value(name, gs_dir, value):
+  client = get_storage_client()
+  if client:
+    (bucket, path) = split_cloud_storage_path('%s/%s' % (gs_dir, name))
+    client.bucket(bucket).blob(path).upload_from_string(str(value))
+    return
   with TempDir() as temp:
     tempfile = os.path.join(temp, name);
     with open(tempfile, 'w') as f:
@@ -309,16 +372,47 @@ def upload_file_to_cloud_storage(source, destination, public_read=True):
   subprocess.check_call(cmd)
 
 def delete_file_from_cloud_storage(destination):
+  client = get_storage_client()
+  if client:
+    (bucket, name) = split_cloud_storage_path(destination)
+    client.bucket(bucket).delete_blob(name)
+    return
   cmd = ['gsutil.py', 'rm', destination]
   PrintCmd(cmd)
   subprocess.check_call(cmd)
 
-def ls_files_on_cloud_storage(destination):
+def ls_files_on_cloud_storage(destination, ignore_errors=False):
+  client = get_storage_client()
+  if client:
+    # Same output as 'gsutil ls' on a directory: files and sub directories.
+    (bucket, prefix) = split_cloud_storage_path(destination)
+    if prefix and not prefix.endswith('/'):
+      prefix += '/'
+    blobs = client.list_blobs(bucket, prefix=prefix, delimiter='/')
+    entries = ['gs://%s/%s' % (bucket, blob.name) for blob in blobs]
+    entries.extend(['gs://%s/%s' % (bucket, p) for p in blobs.prefixes])
+    return '\n'.join(sorted(entries))
   cmd = ['gsutil.py', 'ls', destination]
   PrintCmd(cmd)
-  return subprocess.check_output(cmd)
+  try:
+    return subprocess.check_output(cmd)
+  except subprocess.CalledProcessError as e:
+    if ignore_errors:
+      return ''
+    else:
+      raise e
 
 def cat_file_on_cloud_storage(destination, ignore_errors=False):
+  client = get_storage_client()
+  if client:
+    (bucket, name) = split_cloud_storage_path(destination)
+    try:
+      return client.bucket(bucket).blob(name).download_as_string()
+    except gcs_exceptions.GoogleAPICallError as e:
+      if ignore_errors:
+        return ''
+      else:
+        raise e
   cmd = ['gsutil.py', 'cat', destination]
   PrintCmd(cmd)
   try:
@@ -330,6 +424,10 @@ def cat_file_on_cloud_storage(destination, ignore_errors=False):
       raise e
 
 def file_exists_on_cloud_storage(destination):
+  client = get_storage_client()
+  if client:
+    (bucket, name) = split_cloud_storage_path(destination)
+    return client.bucket(bucket).blob(name).exists()
   cmd = ['gsutil.py', 'ls', destination]
   PrintCmd(cmd)
   return subprocess.call(cmd) == 0
@@ -339,6 +437,11 @@ def download_file_from_cloud_storage(source, destination):
   PrintCmd(cmd)
   subprocess.check_call(cmd)
 
+def download_dir_from_cloud_storage(source, destination):
+  cmd = ['gsutil.py', '-m', 'cp', '-R', source, destination]
+  PrintCmd(cmd)
+  subprocess.check_call(cmd)
+
 def create_archive(name, sources=None):
   if not sources:
     sources = [name]